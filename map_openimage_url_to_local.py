@@ -12,11 +12,17 @@ Supports two input formats:
 """
 
 import os
-import csv
-import json
 import argparse
+
+import orjson
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
+SCAN_WORKERS = 16
+WRITE_BUFFER_LINES = 10_000
+PROGRESS_EVERY = 256
+
 # Parse command line arguments
 parser = argparse.ArgumentParser(description="Map Open Images URLs to local file paths")
 parser.add_argument("--metadata_csv", required=True, help="Path to metadata CSV file")
@@ -34,24 +40,104 @@ image_root = args.image_root
 
 
 print("📘 Loading metadata mapping (URL → ImageID)...")
-url_to_id = {}
-with open(metadata_csv, "r") as f:
-    reader = csv.DictReader(f)
-    for row in reader:
-        url = row["OriginalURL"].strip()
-        img_id = row["ImageID"].strip()
-        url_to_id[url] = img_id
+# Only pull the two columns we need; pandas' C parser is far faster than a
+# per-row csv.DictReader over the full metadata file.
+metadata = pd.read_csv(metadata_csv, usecols=["OriginalURL", "ImageID"], dtype=str)
+url_to_id = dict(
+    zip(metadata["OriginalURL"].str.strip(), metadata["ImageID"].str.strip())
+)
+del metadata
 print(f"✅ Loaded {len(url_to_id):,} entries from metadata CSV")
 
 
-print(f"📂 Indexing local .jpg images under {image_root}...")
-local_id_to_path = {}
-for root, _, files in tqdm(os.walk(image_root), desc="Scanning subfolders"):
-    for file in files:
-        if file.lower().endswith(".jpg"):
-            image_id = os.path.splitext(file)[0]
-            local_id_to_path[image_id] = os.path.join(root, file)
-print(f"✅ Indexed {len(local_id_to_path):,} local image files")
+# Paths are stored relative to image_root as bytes so the index stays compact
+# when it has to hold millions of entries.
+_root_prefix_len = len(image_root.rstrip(os.sep)) + 1
+
+
+def scan_tree(top):
+    """Recursively index .jpg files under `top` using os.scandir (one stat per entry)."""
+    index = {}
+    stack = [top]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.name.lower().endswith(".jpg"):
+                        index[entry.name[:-4]] = entry.path[_root_prefix_len:].encode()
+        except OSError:
+            continue
+    return index
+
+
+def detect_canonical_layout(root):
+    """True when images live at <root>/<id[:2]>/<id>.jpg (sharded OpenImages layout).
+
+    Extensions are matched case-exactly: resolve_local_path only probes the
+    lowercase name, so trees holding .JPG files must fall through to the
+    full scan (which indexes them case-insensitively).
+    """
+    try:
+        with os.scandir(root) as it:
+            shards = [e for e in it if e.is_dir(follow_symlinks=False)]
+    except OSError:
+        return False
+    if not shards or any(len(e.name) != 2 for e in shards):
+        return False
+    verified = False
+    for shard in shards[:4]:
+        try:
+            with os.scandir(shard.path) as it:
+                for entry in it:
+                    if entry.name.lower().endswith(".jpg"):
+                        if not entry.name.endswith(".jpg"):
+                            return False
+                        if not entry.name.startswith(shard.name):
+                            return False
+                        verified = True
+                        break
+        except OSError:
+            return False
+    return verified
+
+
+if detect_canonical_layout(image_root):
+    # The path is a pure function of the ImageID, so skip the O(N) walk and
+    # stat each candidate only when a URL actually matches.
+    print(f"📂 Canonical sharded layout detected under {image_root}; skipping full scan")
+
+    def resolve_local_path(image_id):
+        local_path = os.path.join(image_root, image_id[:2], image_id + ".jpg")
+        return local_path if os.path.exists(local_path) else None
+else:
+    print(f"📂 Indexing local .jpg images under {image_root}...")
+    local_id_to_path = {}
+    top_dirs = []
+    with os.scandir(image_root) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                top_dirs.append(entry.path)
+            elif entry.name.lower().endswith(".jpg"):
+                local_id_to_path[entry.name[:-4]] = entry.path[_root_prefix_len:].encode()
+
+    # Fan the top-level shard folders out across threads: scandir/stat release
+    # the GIL, so the walk parallelizes well on metadata-bound filesystems.
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as pool:
+        for shard_index in tqdm(pool.map(scan_tree, top_dirs),
+                                total=len(top_dirs), desc="Scanning subfolders"):
+            local_id_to_path.update(shard_index)
+    print(f"✅ Indexed {len(local_id_to_path):,} local image files")
+
+    def resolve_local_path(image_id):
+        # The index was just built from a live scandir walk, so a hit here
+        # means the file exists; no need to stat it again.
+        rel_path = local_id_to_path.get(image_id)
+        if rel_path is None:
+            return None
+        return os.path.join(image_root, rel_path.decode())
 
 
 count_matched = 0
@@ -59,11 +145,20 @@ count_url_not_found = 0
 count_file_missing = 0
 
 print("🔗 Mapping input URLs to local files...")
-with open(jsonl_in, "r") as fin, open(jsonl_out, "w") as fout:
-    for line in tqdm(fin, desc="Processing JSONL"):
+# Update the bar in coarse steps; a per-line update recomputes rate/ETA on
+# every iteration, which is pure overhead at millions of lines.
+progress = tqdm(desc="Processing JSONL", unit="line", mininterval=1.0)
+pending_lines = 0
+with open(jsonl_in, "rb") as fin, open(jsonl_out, "wb") as fout:
+    out_buffer = []
+    for line in fin:
+        pending_lines += 1
+        if pending_lines >= PROGRESS_EVERY:
+            progress.update(pending_lines)
+            pending_lines = 0
         if not line.strip():
             continue
-        data = json.loads(line)
+        data = orjson.loads(line)
 
         # --- SINGLE TURN FORMAT ---
         if not is_multi_turn:
@@ -80,23 +175,30 @@ with open(jsonl_in, "r") as fin, open(jsonl_out, "w") as fout:
         if not url:
             data["local_input_image"] = None
             count_url_not_found += 1
-            fout.write(json.dumps(data) + "\n")
-            continue
-
-        image_id = url_to_id.get(url)
-        if not image_id:
-            data["local_input_image"] = None
-            count_url_not_found += 1
         else:
-            local_path = local_id_to_path.get(image_id)
-            if local_path and os.path.exists(local_path):
-                data["local_input_image"] = local_path
-                count_matched += 1
-            else:
+            image_id = url_to_id.get(url)
+            if not image_id:
                 data["local_input_image"] = None
-                count_file_missing += 1
-
-        fout.write(json.dumps(data) + "\n")
+                count_url_not_found += 1
+            else:
+                local_path = resolve_local_path(image_id)
+                if local_path:
+                    data["local_input_image"] = local_path
+                    count_matched += 1
+                else:
+                    data["local_input_image"] = None
+                    count_file_missing += 1
+
+        out_buffer.append(orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE))
+        if len(out_buffer) >= WRITE_BUFFER_LINES:
+            fout.writelines(out_buffer)
+            out_buffer.clear()
+
+    if out_buffer:
+        fout.writelines(out_buffer)
+
+progress.update(pending_lines)
+progress.close()
 
 print("\n Mapping complete.")
 print(f"  Matched successfully: {count_matched:,}")
@@ -1,14 +1,17 @@
 #!/usr/bin/env python3
-"""Download edited images listed in a manifest using multithreading."""
+"""Download edited images listed in a manifest using async I/O."""
 
 import argparse
-import concurrent.futures
+import asyncio
+import functools
+import itertools
+import os
 import sys
 from pathlib import Path
-from urllib.error import HTTPError, URLError
 from urllib.parse import urlsplit
-from urllib.request import Request, urlopen
 
+import aiofiles
+import aiohttp
 from tqdm.auto import tqdm
 
 
@@ -33,7 +36,7 @@ def parse_args() -> argparse.Namespace:
         "--workers",
         type=int,
         default=32,
-        help="Number of concurrent download threads",
+        help="Number of concurrent downloads",
     )
     parser.add_argument(
         "--timeout",
@@ -61,65 +64,110 @@ def read_manifest(path: Path, limit: int) -> list[str]:
     return urls
 
 
+@functools.lru_cache(maxsize=65536)
 def _relative_path(url: str) -> Path:
+    # Pure transformation; memoized so duplicate manifest entries and resume
+    # passes skip the urlsplit allocation and marker scan.
     path = urlsplit(url).path
     if not path:
         return Path("unknown")
     path = path.lstrip("/")
-    marker = "/images/"
-    if marker in path:
-        idx = path.index(marker) + 1  # keep leading 'images/...'
-        path = path[idx:]
+    _, sep, rest = path.partition("/images/")
+    if sep:
+        path = "images/" + rest  # keep leading 'images/...'
     return Path(path)
 
 
-def download_one(url: str, root: Path, timeout: int) -> tuple[str, str | None]:
-    rel_path = _relative_path(url)
-    target = root / rel_path
-    target.parent.mkdir(parents=True, exist_ok=True)
-    if target.exists():
-        return (url, "exists")
-    req = Request(url, headers={"User-Agent": "Mozilla/5.0"})
+# 400k URLs share a few thousand parent directories; remember which ones we
+# already created so most downloads skip the mkdir/stat syscalls entirely.
+# Everything runs on one event-loop thread, so a plain set is safe.
+_created_dirs: set[Path] = set()
+
+
+def _ensure_parent(parent: Path) -> None:
+    if parent not in _created_dirs:
+        parent.mkdir(parents=True, exist_ok=True)
+        _created_dirs.add(parent)
+
+
+# Per-task suffix for .part files so two tasks resolving to the same target
+# can never truncate or rename each other's partial download.
+_part_counter = itertools.count()
+
+
+async def download_one(
+    session: aiohttp.ClientSession,
+    sem: asyncio.Semaphore,
+    url: str,
+    root: Path,
+) -> tuple[str, str | None]:
+    part = None
     try:
-        with urlopen(req, timeout=timeout) as resp, target.open("wb") as out:
-            out.write(resp.read())
+        rel_path = _relative_path(url)
+        target = root / rel_path
+        _ensure_parent(target.parent)
+        if target.exists():
+            return (url, "exists")
+        # Stream to a uniquely named .part file and rename into place on
+        # success, so a crash mid-download can't leave a truncated file that
+        # passes the exists() check.
+        part = target.with_name(f"{target.name}.{next(_part_counter)}.part")
+        async with sem:
+            async with session.get(url) as resp:
+                if resp.status != 200:
+                    return (url, f"http {resp.status}")
+                async with aiofiles.open(part, "wb") as out:
+                    async for chunk in resp.content.iter_chunked(1 << 16):
+                        await out.write(chunk)
+        os.replace(part, target)
         return (url, "downloaded")
-    except HTTPError as err:
-        return (url, f"http {err.code}")
-    except URLError as err:
-        return (url, f"url {err.reason}")
+    except aiohttp.ClientError as err:
+        return (url, f"url {err}")
     except Exception as err:  # noqa: B902
         return (url, f"error {err}")
+    finally:
+        if part is not None:
+            try:
+                part.unlink(missing_ok=True)
+            except OSError:
+                pass
 
 
-def main() -> int:
-    args = parse_args()
+async def run(args: argparse.Namespace) -> int:
     urls = read_manifest(args.manifest, args.limit)
+    # Manifests repeat URLs (retries, multi-turn refs); download each once.
+    urls = list(dict.fromkeys(urls))
     args.output.mkdir(parents=True, exist_ok=True)
 
     total = len(urls)
-    print(f"Downloading {total} files to {args.output} with {args.workers} workers")
+    print(f"Downloading {total} files to {args.output} with {args.workers} concurrent downloads")
     successes = 0
     skipped = 0
     failures: list[tuple[str, str | None]] = []
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as pool:
-        future_map = {
-            pool.submit(download_one, url, args.output, args.timeout): url for url in urls
-        }
-        for future in tqdm(
-            concurrent.futures.as_completed(future_map),
+    sem = asyncio.Semaphore(args.workers)
+    connector = aiohttp.TCPConnector(limit=args.workers, ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(
+        connector=connector,
+        timeout=timeout,
+        headers={"User-Agent": "Mozilla/5.0"},
+    ) as session:
+        tasks = [
+            asyncio.ensure_future(download_one(session, sem, url, args.output))
+            for url in urls
+        ]
+        for task in tqdm(
+            asyncio.as_completed(tasks),
             total=total,
             desc="Downloads",
             unit="img",
         ):
-            url = future_map[future]
             try:
-                _, status = future.result()
+                url, status = await task
             except Exception as err:  # noqa: B902
-                failures.append((url, f"exception {err}"))
+                failures.append(("<unknown>", f"exception {err}"))
                 continue
-
             if status == "downloaded":
                 successes += 1
             elif status == "exists":
@@ -140,5 +188,9 @@ def main() -> int:
     return 0 if not failures else 1
 
 
+def main() -> int:
+    return asyncio.run(run(parse_args()))
+
+
 if __name__ == "__main__":
     sys.exit(main())